@@ -1,12 +1,21 @@
+import io
 import os
+import re
+import sys
+import threading
+import json
+import asyncio
+import hashlib
 import subprocess
+import tempfile
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass, field
-from functools import cache, cached_property
+from functools import cache, cached_property, lru_cache, partial
 from enum import Enum
-from queue import SimpleQueue
+from stat import S_ISREG
 from time import time
 from argparse import ArgumentParser
-from sys import argv
 
 class bcolors:
     HEADER = '\033[95m'
@@ -33,7 +42,7 @@ class Timer:
         self.elapsed = self._end - self._start
 
 def _Parse_Target(args: tuple[str] = None) -> str:
-    parser = ArgumentParser(args[0] if args else argv[0], description='MSVC-based C++latest project management')
+    parser = ArgumentParser(args[0] if args else sys.argv[0], description='MSVC-based C++latest project management')
     parser.add_argument('target', type=str, choices=['build', 'rebuild', 'clean', 'test'])
     args = parser.parse_args(args=args)
     return args.target
@@ -45,12 +54,15 @@ class CompilationError(RuntimeError):
 def _Basename_Ext(path: os.PathLike, ext: str) -> os.PathLike:
     return f'{os.path.basename(path)}{ext}' 
 
+@lru_cache(maxsize=4096)
 def _Path_Join(*parts: os.PathLike) -> os.PathLike:
     return os.path.normpath(os.path.join(*parts))
 
+@lru_cache(maxsize=4096)
 def _Path_Dir(path: os.PathLike) -> os.PathLike:
     return os.path.normpath(os.path.dirname(os.path.realpath(path)))
 
+@lru_cache(maxsize=4096)
 def _Dot_Path(path: os.PathLike, add_ext: str = None, strip_ext: bool = False) -> str:
     if strip_ext:
         path = os.path.splitext(path)[0]
@@ -59,26 +71,182 @@ def _Dot_Path(path: os.PathLike, add_ext: str = None, strip_ext: bool = False) -
     parts = os.path.normpath(path).split(os.sep)
     return '.'.join((p for p in parts if p))
 
-def _Should_Rebuild(src: os.PathLike, dst: os.PathLike) -> bool:
-    assert os.path.exists(src), f'source file {src} does not exist'
-    return (not os.path.exists(dst)) or (os.path.getmtime(src) > os.path.getmtime(dst))
+# stamps record the stat and digest of the source an output was last built from:
+# an unchanged stat skips hashing, while a rewritten mtime (checkout, clone, CI caches)
+# only costs a rehash instead of a rebuild
+def _Stamp_Path(dst: os.PathLike) -> os.PathLike:
+    return _Path_Join(os.path.dirname(dst), '.stamps', _Basename_Ext(dst, '.blake2'))
+
+# keyed on the stat as well, so a source modified in between is hashed again
+@cache
+def _Source_Digest(src: os.PathLike, mtime_ns: int, size: int) -> str:
+    with open(src, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+def _Read_Stamp(dst: os.PathLike) -> tuple[int, int, str]:
+    try:
+        with open(_Stamp_Path(dst)) as stamp:
+            mtime_ns, size, digest = stamp.read().split()
+        return int(mtime_ns), int(size), digest
+    except (FileNotFoundError, ValueError):
+        return None
+
+# stats are taken by the caller (None for missing files), see Project._stat
+def _Should_Rebuild(src: os.PathLike, dst: os.PathLike, 
+                    src_stat: os.stat_result, dst_stat: os.stat_result) -> bool:
+    assert src_stat, f'source file {src} does not exist'
+    if dst_stat is None:
+        return True
+    stamp = _Read_Stamp(dst)
+    if stamp is None:
+        return True
+    if stamp[:2] == (src_stat.st_mtime_ns, src_stat.st_size):
+        return False
+    if stamp[2] != _Source_Digest(src, src_stat.st_mtime_ns, src_stat.st_size):
+        return True
+    # touched but not modified
+    _Write_Stamp(src, dst, src_stat)
+    return False
+
+def _Write_Stamp(src: os.PathLike, dst: os.PathLike, src_stat: os.stat_result, digest: str = None):
+    stamp = _Stamp_Path(dst)
+    os.makedirs(os.path.dirname(stamp), exist_ok=True)
+    with open(stamp, 'w') as f:
+        digest = digest or _Source_Digest(src, src_stat.st_mtime_ns, src_stat.st_size)
+        f.write(f'{src_stat.st_mtime_ns} {src_stat.st_size} {digest}')
+
+_INCLUDE_PATTERN = re.compile(rb'^\s*(?:#\s*include|(?:export\s+)?import)\s*([<"])([^>"]+)[>"]', re.M)
+_COMMENT_PATTERN = re.compile(rb'/\*.*?\*/|//[^\n]*', re.S)
+
+# names are returned relative to the source directory; quoted names may also be
+# relative to the including file (key), so both readings are returned
+def _Scan_Includes(path: os.PathLike, key: str) -> set[str]:
+    with open(path, 'rb') as f:
+        includes = set()
+        for quote, name in _INCLUDE_PATTERN.findall(_COMMENT_PATTERN.sub(b'', f.read())):
+            name = name.decode()
+            includes.add(os.path.normpath(name))
+            if quote == b'"':
+                includes.add(os.path.normpath(os.path.join(os.path.dirname(key), name)))
+        return includes
+
+# groups keys by dependency depth (Kahn's algorithm),
+# so that each level only depends on the levels before it;
+# keys caught in a cycle (e.g. #pragma once headers including each other, 
+# or includes in #if 0 blocks) are left one per level, in their original order
+def _Dependency_Levels(dependencies: dict[str, set[str]]) -> list[list[str]]:
+    pending = { key: deps & dependencies.keys() for key, deps in dependencies.items() }
+    levels = []
+    while pending:
+        level = [ key for key, deps in pending.items() if not deps ]
+        if not level:
+            print(f':> Circular dependency between {", ".join(pending)}, building them one by one')
+            levels += [ [ key ] for key in pending ]
+            break
+        for key in level:
+            del pending[key]
+        for deps in pending.values():
+            deps.difference_update(level)
+        levels.append(level)
+    return levels
+
+# longer command lines are passed to the tools as @response files, 
+# staying clear of the 8191 characters limit of cmd.exe and friends
+_RESPONSE_FILE_THRESHOLD = 7500
+
+# tools are looked up on PATH once per process rather than by every CreateProcess call
+@cache
+def _Tool_Path(tool: str) -> str:
+    from shutil import which
+    return which(tool) or tool
+
+# runs the tool directly, without cmd.exe in between; every argument has to be separate.
+# raises CompilationError once the output is drained if the tool exited with an error
+def _Shell_Stream(*args: str) -> Iterator[str]:
+    args = (_Tool_Path(args[0]), *args[1:])
+    rsp = None
+    if sum(len(arg) + 1 for arg in args) > _RESPONSE_FILE_THRESHOLD:
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.rsp', delete=False) as f:
+            f.write('\n'.join(subprocess.list2cmdline([arg]) for arg in args[1:]))
+        rsp = f.name
+        args = (args[0], f'@{rsp}')
+
+    try:
+        with subprocess.Popen(list(args), encoding='utf-8', bufsize=1,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as p:
+            for line in p.stdout:
+                line = line.rstrip()
+                if line:
+                    yield line
+        if p.returncode != 0:
+            raise CompilationError(f'{os.path.basename(args[0])} exited with code {p.returncode}')
+    finally:
+        if rsp:
+            os.remove(rsp)
+
+# keeps the output of a failed command, so it is still reported along with the error
+def _Shell_Capture(*args: str) -> tuple[list[str], CompilationError]:
+    stdout = []
+    try:
+        stdout.extend(_Shell_Stream(*args))
+    except CompilationError as e:
+        return stdout, e
+    return stdout, None
+
+def _Shell_Report(stdout: Iterable[str], error: CompilationError = None):
+    failed = False
+    for line in stdout:
+        print('  [stdout]', line)
+        failed = failed or 'error C' in line
+    if error:
+        raise error
+    if failed:
+        raise CompilationError()
 
 def _Shell_Exec(*args: str):
-    cmd = ' '.join(args)
-    print(f':MSVC> {cmd}')
-    r = subprocess.run(cmd, shell=True, capture_output=True)
-    
-    stdout = r.stdout.decode('utf-8').strip()
-    if stdout.startswith('Microsoft (R)'):
-        stdout = '\n'.join( stdout.splitlines()[2:] )
-
-    if stdout:
-        print('  [stdout]', stdout)
-        # print('---')
-        if 'error C' in stdout:
-            raise CompilationError()
-    #if r.stderr:
-    #    print('    stderr:', r.stderr.decode('utf-8'))
+    print(f':MSVC> {" ".join(args)}')
+    _Shell_Report(_Shell_Stream(*args))
+
+# waiting on a subprocess releases the GIL, so threads are enough to keep N compilers busy;
+# a single pool serves the whole process, so its workers stay warm across
+# header unit levels, translation unit batches and projects
+@cache
+def _Shell_Executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# output is reported in completion order so that parallel commands don't interleave
+def _Shell_Exec_All(commands: list[list[str]], parallel: bool = True, 
+                    on_success: Callable[[list[str]], None] = None):
+    if not parallel:
+        for cmd in commands:
+            _Shell_Exec(*cmd)
+            if on_success:
+                on_success(cmd)
+        return
+
+    futures = { _Shell_Executor().submit(_Shell_Capture, *cmd): cmd for cmd in commands }
+    for f in as_completed(futures):
+        cmd = futures[f]
+        print(f':MSVC> {" ".join(cmd)}')
+        try:
+            _Shell_Report(*f.result())
+        except CompilationError:
+            for pending in futures:
+                pending.cancel()
+            raise
+        if on_success:
+            on_success(cmd)
+
+# communicate() drains stdout and stderr together, so neither pipe can stall the other
+# every test gets a scratch working directory of its own, so that tests creating
+# cwd-relative files (e.g. fswatched/) don't trip over each other when run side by side
+async def _Test_Exec(test: os.PathLike, limit: asyncio.Semaphore) -> tuple[int, bytes, bytes]:
+    async with limit:
+        with tempfile.TemporaryDirectory(prefix='test_', ignore_cleanup_errors=True) as cwd:
+            p = await asyncio.create_subprocess_exec(os.path.abspath(test), cwd=cwd, 
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = await p.communicate()
+        return p.returncode, stdout, stderr
 
 class _Msvc_Tool(Enum):
     Compiler = 'CL.EXE'
@@ -101,10 +269,14 @@ class _CFlag(Enum):
     InlineFunctionsExpansion = '/Ob2'
     WholeProgramOptimization = '/GL'
     LinkTimeCodeGeneration = '/LTCG'
+    MultiProcess = '/MP'
+    NoLogo = '/nologo'
+    ForcePdbSerialization = '/FS'
 
 class _LFlag(Enum):
     WError = '/WX'
     Debug = '/DEBUG:FULL'
+    NoLogo = '/NOLOGO'
 
 class _IfcFlag(Enum):
     TranslationUnit = '/TP'
@@ -187,6 +359,8 @@ class ObjectAccumulator:
 class HeaderUnitAccumulator:
     exported: dict[str, os.PathLike] = field(default_factory=dict)
     included: list[str] = field(default_factory=list)
+    # key: header unit, value: (src file, obj file, command arguments)
+    scheduled: dict[str, tuple[os.PathLike, os.PathLike, list[str]]] = field(default_factory=dict)
 
     def on_export(self, hxx: os.PathLike, ifc: os.PathLike) -> list[str]:
         assert not hxx in self.exported, f'header unit {hxx} is already exported'
@@ -194,31 +368,59 @@ class HeaderUnitAccumulator:
         kv = f'{hxx}={ifc}'
         self.included.append(_IfcFlag.IncludeGlobalHeaderUnit.value)
         self.included.append(kv)
-        return [ _IfcFlag.ExportGlobalHeaderUnit.value, hxx ]
+        return [ *_IfcFlag.ExportGlobalHeaderUnit.value.split(), hxx ]
+
+    def on_schedule(self, hxx: os.PathLike, src: os.PathLike, obj: os.PathLike, cmd: list[str]):
+        self.scheduled[hxx] = (src, obj, cmd)
 
 @dataclass
 class ModuleAccumulator:
     exported: dict[str, os.PathLike] = field(default_factory=dict)
+    # key: ixx file, value: (obj file, command arguments), in the order interfaces were added
+    scheduled: dict[os.PathLike, tuple[os.PathLike, list[str]]] = field(default_factory=dict)
 
     def on_interface(self, ixx: os.PathLike, name: str, ifc: os.PathLike) -> list[str]:
         assert not name in self.exported, f'module {name} already exists'
         self.exported[name] = ifc
         return [ _IfcFlag.Interface.value, ixx ]
 
+    def on_schedule(self, ixx: os.PathLike, obj: os.PathLike, cmd: list[str]):
+        self.scheduled[ixx] = (obj, cmd)
+
 
-# TODO: batch pass multiple /TP ${cpp} files to CL.EXE in a single call
-# TODO: batch pass multiple ${cxx} files to CL.EXE in a single call
+# batches sources per language so that each one is compiled by a single CL.EXE call
 @dataclass
 class TranslationUnitAccumulator:
+    # key: src file, value: obj file
     scheduled: dict[os.PathLike, os.PathLike] = field(default_factory=dict)
+    c_batch: list[os.PathLike] = field(default_factory=list)
+    cpp_batch: list[os.PathLike] = field(default_factory=list)
+    cxx_batch: list[os.PathLike] = field(default_factory=list)
     
-    def on_schedule(self, cpp: os.PathLike, obj: os.PathLike):
-        pass
+    def on_schedule(self, src: os.PathLike, obj: os.PathLike):
+        assert not src in self.scheduled, f'translation unit {src} is already scheduled'
+        self.scheduled[src] = obj
+        match os.path.splitext(src)[1]:
+            case '.c':
+                self.c_batch.append(src)
+            case '.cpp':
+                self.cpp_batch.append(src)
+            case '.cxx':
+                self.cxx_batch.append(src)
+            case ext:
+                raise RuntimeError(f'Unsupported translation unit type {ext}: {src}')
+
+    def __len__(self) -> int:
+        return len(self.scheduled)
 
 @dataclass
 class IfcMapAccumulator:
     external: dict[str, os.PathLike] = field(default_factory=dict)
 
+    def on_link(self, name: str, ifc_map: os.PathLike):
+        self.external[name] = ifc_map
+        self.__dict__.pop('compiler_args', None)
+
     @cached_property
     def compiler_args(self):
         r = []
@@ -249,20 +451,42 @@ class Project:
     header_units: HeaderUnitAccumulator = field(default_factory=HeaderUnitAccumulator)
     modules: ModuleAccumulator = field(default_factory=ModuleAccumulator)
     object_files: ObjectAccumulator = field(default_factory=ObjectAccumulator)
-    deferred_commands: SimpleQueue[list[str]] = field(default_factory=SimpleQueue)
+    translation_units: TranslationUnitAccumulator = field(default_factory=TranslationUnitAccumulator)
+    deferred_commands: list[list[str]] = field(default_factory=list)
     ifc_maps: IfcMapAccumulator = field(default_factory=IfcMapAccumulator)
+    depends_on: set[str] = field(default_factory=set)
 
     _modules_directory: os.PathLike = None
     _cache_directory: os.PathLike = None
+    _src_prefix: str = None
     _rebuilt_objects: int = 0
+    # whether this build changed ifcs, the ifc map or headers, which tests compile against
+    _tests_outdated: bool = False
+    _stat_cache: dict[os.PathLike, os.stat_result] = field(default_factory=dict)
     _total_objects: int = 0
     _force_rebuild: bool = False
+    # cores this project may keep busy with /MP, shared out by Solution.build
+    _cores: int = None
+    # (src file, obj file, schedule, is interface) in the order sources were added
+    _added_units: list[tuple[os.PathLike, os.PathLike, Callable[[], None], bool]] = field(default_factory=list)
+    _previous_state: dict = field(default_factory=dict)
+    # key: src file, value: headers it included when it was last compiled
+    _dependencies: dict[os.PathLike, list[os.PathLike]] = field(default_factory=dict)
+    # key: header or linked library file, value: (mtime_ns, size, digest) as of this build
+    _input_stamps: dict[os.PathLike, list] = field(default_factory=dict)
+    _scanned_includes: dict[os.PathLike, set[str]] = field(default_factory=dict)
+    _linked_libraries: list['Project'] = field(default_factory=list)
+    _relink: bool = False
+    # key: output file, value: (stat, digest) of its source when it was scheduled
+    _snapshots: dict[os.PathLike, tuple[os.stat_result, str]] = field(default_factory=dict)
     
 
     def __post_init__(self):
         self.source_directory = os.path.normpath(self.source_directory)
         self.build_directory = os.path.normpath(self.build_directory)
         self.tests_directory = os.path.normpath(self.tests_directory)
+        self._src_prefix = self.source_directory + os.sep
+        self._cores = self._cores or os.cpu_count() or 1
 
         self._modules_directory = os.path.normpath(os.path.join(self.build_directory, 'ifc'))
         os.makedirs(self._modules_directory, exist_ok=True)
@@ -270,6 +494,9 @@ class Project:
         self._cache_directory = os.path.normpath(os.path.join(self.build_directory, 'obj'))
         os.makedirs(self._cache_directory, exist_ok=True)
 
+        self._previous_state = self._load_state()
+        self._dependencies = self._previous_state.get('dependencies', {})
+
     @cached_property
     def output_file(self):
         return os.path.normpath(f'{self.build_directory}/{self.name}{self.type.value}')
@@ -296,30 +523,202 @@ class Project:
     def ifc_search_dir(self):
         return [ _IfcFlag.IfcSearchDir.value, self._modules_directory ]
 
+    # shared by every C++ unit of the project, 
+    # has to be invalidated whenever header units or ifc maps are added
+    @cached_property
+    def _compile_prefix(self) -> list[str]:
+        return [ 
+            # commands run side by side and share the project's pdb
+            _Msvc_Tool.Compiler.value, _CFlag.NoLogo.value, _CFlag.Linkless.value, _CFlag.ForcePdbSerialization.value,
+            *self.config.compiler_args,
+            *self.common_flags,
+            *self.ifc_search_dir,
+            *self.header_units.included,
+            *self.ifc_maps.compiler_args
+        ]
+
+    def _invalidate_compile_prefix(self):
+        self.__dict__.pop('_compile_prefix', None)
+
+    # every path is stat'ed at most once per build, 
+    # outputs are dropped from the cache as soon as they are rewritten
+    def _stat(self, path: os.PathLike) -> os.stat_result:
+        if not path in self._stat_cache:
+            try:
+                self._stat_cache[path] = os.stat(path)
+            except FileNotFoundError:
+                self._stat_cache[path] = None
+        return self._stat_cache[path]
+
+    def _should_rebuild(self, src: os.PathLike, dst: os.PathLike) -> bool:
+        return _Should_Rebuild(src, dst, self._stat(src), self._stat(dst))
+
+    # the source is stat'ed and hashed before the tool runs, so that a source saved
+    # in the meantime is stamped with what was actually compiled and rebuilt next time
+    def _snapshot(self, src: os.PathLike, dst: os.PathLike):
+        src_stat = self._stat(src)
+        self._snapshots[dst] = (src_stat, _Source_Digest(src, src_stat.st_mtime_ns, src_stat.st_size))
+
+    def _stamp(self, src: os.PathLike, dst: os.PathLike):
+        self._stat_cache.pop(dst, None)
+        src_stat, digest = self._snapshots.pop(dst, None) or (self._stat(src), None)
+        _Write_Stamp(src, dst, src_stat, digest)
+
+    # outputs are unstamped as soon as they are scheduled, so that a build failing
+    # before they are written again leaves them out of date instead of stale
+    def _unstamp(self, dst: os.PathLike):
+        self._stat_cache.pop(dst, None)
+        try:
+            os.remove(_Stamp_Path(dst))
+        except FileNotFoundError:
+            pass
+
+    def _add_unit(self, src: os.PathLike, obj: os.PathLike, schedule: Callable[[], None], interface: bool = False):
+        self._added_units.append((src, obj, schedule, interface))
+        self._total_objects += 1
+
+    # inputs are hashed once per build, before anything is compiled,
+    # and only if their stat differs from the one recorded by the last build
+    def _input_stamp(self, path: os.PathLike) -> list:
+        if not path in self._input_stamps:
+            st = self._stat(path)
+            previous = self._previous_state.get('inputs', {}).get(path)
+            if st is None:
+                self._input_stamps[path] = None
+            elif previous and previous[:2] == [ st.st_mtime_ns, st.st_size ]:
+                self._input_stamps[path] = previous
+            else:
+                self._input_stamps[path] = [ st.st_mtime_ns, st.st_size, _Source_Digest(path, st.st_mtime_ns, st.st_size) ]
+        return self._input_stamps[path]
+
+    def _input_changed(self, path: os.PathLike) -> bool:
+        stamp, previous = self._input_stamp(path), self._previous_state.get('inputs', {}).get(path)
+        return (stamp and stamp[2]) != (previous and previous[2])
+
+    # headers under the source directory that src includes, directly or through other headers;
+    # system headers are covered by compiler_args, header units and modules by interface rebuilds
+    def _scan_dependencies(self, src: os.PathLike) -> list[os.PathLike]:
+        headers, pending = set(), [ src ]
+        while pending:
+            path = pending.pop()
+            if not path in self._scanned_includes:
+                self._scanned_includes[path] = _Scan_Includes(path, path.removeprefix(self._src_prefix))
+            for name in self._scanned_includes[path]:
+                header = _Path_Join(self.source_directory, name)
+                st = self._stat(header)
+                if not header in headers and st and S_ISREG(st.st_mode):
+                    headers.add(header)
+                    pending.append(header)
+        return sorted(headers)
+
+    # units whose dependencies were never recorded are rebuilt, to be safe
+    def _dependencies_changed(self, src: os.PathLike) -> bool:
+        headers = self._dependencies.get(src)
+        return headers is None or any(self._input_changed(header) for header in headers)
+
+    # C's objects are compiled against the ifcs of the libraries it links, 
+    # and C.lib bundles their .lib files
+    def _check_linked_libraries(self) -> bool:
+        interfaces = [ 
+            self._input_changed(path) for lib in self._linked_libraries 
+            for path in (lib.ifc_map, *lib.header_units.exported.values(), *lib.modules.exported.values())
+        ]
+        outputs = [ self._input_changed(lib.output_file) for lib in self._linked_libraries ]
+        self._relink = any(outputs)
+        return any(interfaces)
+
+    # a unit is rebuilt if its source or a header it includes changed, or if the compiler flags 
+    # or linked libraries changed since the last build; once an interface is rebuilt, 
+    # every unit added after it is rebuilt as well, since it may import that interface
+    def _schedule_units(self):
+        self._input_stamps.clear()
+        self._scanned_includes.clear()
+        rebuild_all = self._force_rebuild
+        previous = self._previous_state
+        libraries_changed = self._check_linked_libraries()
+        if previous and (previous.get('compiler_args') != self.config.compiler_args 
+                         or previous.get('ifc_maps') != self.ifc_maps.external
+                         or libraries_changed):
+            print(f':> Rebuilding all of {self.name} (compiler flags or linked libraries changed)')
+            rebuild_all = True
+        self._tests_outdated = self._tests_outdated or rebuild_all
+
+        # interfaces first: a rebuilt interface rebuilds the interfaces added after it
+        # and every other unit, whatever order they were added in
+        for interfaces in (True, False):
+            for src, obj, schedule, interface in self._added_units:
+                if interface != interfaces:
+                    continue
+                if rebuild_all or self._should_rebuild(src, obj) or self._dependencies_changed(src):
+                    self._unstamp(obj)
+                    self._snapshot(src, obj)
+                    self._dependencies[src] = self._scan_dependencies(src)
+                    if any([ self._input_changed(header) for header in self._dependencies[src] ]):
+                        self._tests_outdated = True
+                    schedule()
+                    self._rebuilt_objects += 1
+                    rebuild_all = rebuild_all or interface
+                    self._tests_outdated = self._tests_outdated or interface
+                else:
+                    print(f':> Not building {src.removeprefix(self._src_prefix)} (no changes)')
+        self._added_units.clear()
+
+    # removes objects and interfaces of sources that are no longer part of the project,
+    # returns whether there were any
+    def _prune_outputs(self) -> bool:
+        stale = [ obj for obj in self._previous_state.get('objects', {}) if not obj in self.object_files.compiled ]
+        stale += [ 
+            ifc for name, ifc in self._previous_state.get('header_units', {}).items() if not name in self.header_units.exported 
+        ]
+        stale += [ 
+            ifc for name, ifc in self._previous_state.get('modules', {}).items() if not name in self.modules.exported 
+        ]
+        for path in stale:
+            for output in (path, _Stamp_Path(path)):
+                try:
+                    os.remove(output)
+                except FileNotFoundError:
+                    pass
+            print(f':> Removed {path} (source is gone)')
+        return bool(stale)
+
+    @property
+    def state_file(self):
+        return _Path_Join(self.build_directory, '.state.json')
+
+    def _load_state(self) -> dict:
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_state(self):
+        self._previous_state = {
+            'compiler_args': self.config.compiler_args,
+            'ifc_maps': self.ifc_maps.external,
+            'objects': self.object_files.compiled,
+            'header_units': self.header_units.exported,
+            'modules': self.modules.exported,
+            'dependencies': self._dependencies,
+            'inputs': { path: stamp for path, stamp in self._input_stamps.items() if stamp },
+        }
+        with open(self.state_file, 'w') as f:
+            json.dump(self._previous_state, f, indent=2)
+
+    # batched compilation writes objects as /Fo<dir>\<basename>.obj, 
+    # so colliding basenames are caught by ObjectAccumulator.on_compile
+    def _batched_object_file(self, src: os.PathLike) -> os.PathLike:
+        return _Path_Join(self._cache_directory, _Basename_Ext(os.path.splitext(src)[0], '.obj'))
+
     def add_c_translation_unit(self, c: os.PathLike):
         assert os.path.splitext(c)[1] == '.c', f'file extension mismatch: expected .c, got {c}'
 
-        obj = _Path_Join(self._cache_directory, _Dot_Path(c, add_ext='.obj'))
+        obj = self._batched_object_file(c)
         c = _Path_Join(self.source_directory, c)
+        self.object_files.on_compile(c, obj)
 
-        cmd = [ _Msvc_Tool.Compiler.value, _CFlag.Linkless.value ]
-        cmd.append('/std:c17')
-        if self.config.type == ConfigType.Debug:
-            cmd.append('/Zi')
-        cmd.append('/I')
-        cmd.append(self.source_directory)
-        cmd.append(c)
-        cmd.append(self.object_files.on_compile(c, obj))
-        cmd.append(self.pdb_file_flag)
-        cmd.append(self.output_file_flag)
-
-        if not self._force_rebuild and _Should_Rebuild(c, obj):
-            self.deferred_commands.put(cmd)
-            self._rebuilt_objects += 1
-        else:
-            print(f':> Not building {os.path.relpath(c, self.source_directory)} (no changes)')
-        # _Shell_Exec(*cmd)
-        self._total_objects += 1
+        self._add_unit(c, obj, partial(self.translation_units.on_schedule, c, obj))
         return self
 
     def add_header_unit(self, hxx: os.PathLike):
@@ -329,25 +728,17 @@ class Project:
         obj = os.path.join(self._cache_directory, _Dot_Path(hxx, add_ext='.obj', strip_ext=True))
         hxx = os.path.normpath(hxx)
 
-        cmd = [ _Msvc_Tool.Compiler.value, _CFlag.Linkless.value ]
-        cmd += self.config.compiler_args
-        cmd += self.common_flags
-        cmd += self.ifc_search_dir
-        cmd += self.header_units.on_export(hxx, ifc)
-        cmd += self.header_units.included
-        cmd += self.ifc_maps.compiler_args
+        # _compile_prefix is prepended once all header units are known
+        cmd = self.header_units.on_export(hxx, ifc)
+        self._invalidate_compile_prefix()
         cmd += [ _IfcFlag.IfcOutput.value, ifc ]
         cmd.append(self.object_files.on_compile(hxx, obj))
         cmd.append(self.pdb_file_flag)
         cmd.append(self.output_file_flag)
 
         assert not hxx.startswith('C:\\')
-        if not self._force_rebuild and _Should_Rebuild(os.path.join(self.source_directory, hxx), obj):
-            _Shell_Exec(*cmd)
-            self._rebuilt_objects += 1
-        else:
-            print(f':> Not building {hxx} (no changes)')
-        self._total_objects += 1
+        src = os.path.join(self.source_directory, hxx)
+        self._add_unit(src, obj, partial(self.header_units.on_schedule, hxx, src, obj, cmd), interface=True)
         return self
 
     def add_module_interface(self, ixx: os.PathLike):
@@ -358,79 +749,86 @@ class Project:
         obj = _Path_Join(self._cache_directory, _Dot_Path(ixx, add_ext='.obj'))
         ixx = _Path_Join(self.source_directory, ixx)
 
-        cmd = [ _Msvc_Tool.Compiler.value, _CFlag.Linkless.value ]
-        cmd += self.config.compiler_args
-        cmd += self.common_flags
-        cmd += self.ifc_search_dir
-        cmd += self.header_units.included
-        cmd += self.ifc_maps.compiler_args
-        cmd += self.modules.on_interface(ixx, name, ifc)
+        # _compile_prefix is prepended once all header units are known
+        cmd = self.modules.on_interface(ixx, name, ifc)
         cmd += [ _IfcFlag.IfcOutput.value, ifc ]
         cmd.append(self.object_files.on_compile(ixx, obj))
         cmd.append(self.pdb_file_flag)
         cmd.append(self.output_file_flag)
 
-        if not self._force_rebuild and _Should_Rebuild(ixx, obj):
-            _Shell_Exec(*cmd)
-            self._rebuilt_objects += 1
-        else:
-            print(f':> Not building {os.path.relpath(ixx, self.source_directory)} (no changes)')
-        self._total_objects += 1
+        self._add_unit(ixx, obj, partial(self.modules.on_schedule, ixx, obj, cmd), interface=True)
         return self
 
     def add_module_implementation(self, cxx: os.PathLike):
         assert os.path.splitext(cxx)[1] == '.cxx', f'file extension mismatch: expected .cxx, got {cxx}'
 
-        obj = _Path_Join(self._cache_directory, _Dot_Path(cxx, add_ext='.obj'))
+        obj = self._batched_object_file(cxx)
         cxx = _Path_Join(self.source_directory, cxx)
-        #obj = os.path.join(self._cache_directory, _Basename_Ext(cxx, '.obj'))
-        
-        cmd = [ _Msvc_Tool.Compiler.value, _CFlag.Linkless.value ]
-        cmd += self.config.compiler_args
-        cmd += self.common_flags
-        cmd += self.ifc_search_dir
-        cmd += self.header_units.included
-        cmd += self.ifc_maps.compiler_args
-        cmd.append(cxx)
-        cmd.append(self.object_files.on_compile(cxx, obj))
-        cmd.append(self.pdb_file_flag)
-        cmd.append(self.output_file_flag)
+        self.object_files.on_compile(cxx, obj)
 
-        if not self._force_rebuild and _Should_Rebuild(cxx, obj):
-            self.deferred_commands.put(cmd)
-            self._rebuilt_objects += 1
-        else:
-            print(f':> Not building {os.path.relpath(cxx, self.source_directory)} (no changes)')
-        # _Shell_Exec(*cmd)
-        self._total_objects += 1
+        self._add_unit(cxx, obj, partial(self.translation_units.on_schedule, cxx, obj))
         return self
         
     def add_translation_unit(self, cpp: os.PathLike):
         assert os.path.splitext(cpp)[1] == '.cpp', f'file extension mismatch: expected .cpp, got {cpp}'
 
-        obj = _Path_Join(self._cache_directory, _Dot_Path(cpp, add_ext='.obj'))
+        obj = self._batched_object_file(cpp)
         cpp = _Path_Join(self.source_directory, cpp)
-        
-        cmd = [ _Msvc_Tool.Compiler.value, _CFlag.Linkless.value ]
-        cmd += self.config.compiler_args
-        cmd += self.common_flags
-        cmd += self.ifc_search_dir
-        cmd += self.header_units.included
-        cmd += self.ifc_maps.compiler_args
-        cmd.append(_IfcFlag.TranslationUnit.value)
-        cmd.append(cpp)
-        cmd.append(self.object_files.on_compile(cpp, obj))
-        cmd.append(self.pdb_file_flag)
-        cmd.append(self.output_file_flag)
+        self.object_files.on_compile(cpp, obj)
 
-        if not self._force_rebuild and _Should_Rebuild(cpp, obj):
-            self.deferred_commands.put(cmd)
-            self._rebuilt_objects += 1
-        else:
-            print(f':> Not building {os.path.relpath(cpp, self.source_directory)} (no changes)')
-        # _Shell_Exec(*cmd)
-        self._total_objects += 1
+        self._add_unit(cpp, obj, partial(self.translation_units.on_schedule, cpp, obj))
         return self
+
+    def _schedule_batches(self, multiprocess: bool):
+        batch_output = [ f'{_CFlag.ObjPath.value}{self._cache_directory}{os.sep}', self.pdb_file_flag ]
+        if multiprocess:
+            batch_output.append(f'{_CFlag.MultiProcess.value}{self._cores}')
+
+        if self.translation_units.c_batch:
+            cmd = [ _Msvc_Tool.Compiler.value, _CFlag.NoLogo.value, _CFlag.Linkless.value, _CFlag.ForcePdbSerialization.value ]
+            cmd.append('/std:c17')
+            if self.config.type == ConfigType.Debug:
+                cmd.append('/Zi')
+            cmd.append('/I')
+            cmd.append(self.source_directory)
+            cmd += self.translation_units.c_batch
+            cmd += batch_output
+            self.deferred_commands.append(cmd)
+
+        for ifc_flags, batch in (
+            ([ _IfcFlag.TranslationUnit.value ], self.translation_units.cpp_batch),
+            ([], self.translation_units.cxx_batch),
+        ):
+            if not batch:
+                continue
+            cmd = self._compile_prefix + ifc_flags
+            cmd += batch
+            cmd += batch_output
+            self.deferred_commands.append(cmd)
+
+    # header units only wait for the header units they include,
+    # module interfaces are compiled one by one as they may import each other
+    def _compile_interfaces(self):
+        scheduled = self.header_units.scheduled
+        dependencies = { hxx: _Scan_Includes(src, hxx) - { hxx } for hxx, (src, _, _) in scheduled.items() }
+        for level in _Dependency_Levels(dependencies):
+            _Shell_Exec_All([ self._compile_prefix + scheduled[hxx][2] for hxx in level ], 
+                            on_success=self._on_header_unit_compiled)
+
+        for ixx, (obj, cmd) in self.modules.scheduled.items():
+            _Shell_Exec(*self._compile_prefix, *cmd)
+            self._stamp(ixx, obj)
+
+    def _on_header_unit_compiled(self, cmd: list[str]):
+        for hxx in cmd:
+            if hxx in self.header_units.scheduled:
+                src, obj, _ = self.header_units.scheduled[hxx]
+                self._stamp(src, obj)
+
+    def _on_batch_compiled(self, cmd: list[str]):
+        for src in cmd:
+            if src in self.translation_units.scheduled:
+                self._stamp(src, self.translation_units.scheduled[src])
     
     def add_sources(self, sources: list[os.PathLike]):
         for source in sources:
@@ -455,7 +853,11 @@ class Project:
         src = os.path.realpath(self.source_directory)
         dst = os.path.realpath(self.build_directory)
         assert src != dst and (dst.startswith(src) or not src.startswith(dst))
+        for memoized in (_Path_Join, _Path_Dir, _Dot_Path):
+            memoized.cache_clear()
         rmtree(self.build_directory)
+        self._previous_state = {}
+        self._dependencies = {}
         os.makedirs(self._modules_directory, exist_ok=True)
         os.makedirs(self._cache_directory, exist_ok=True)
         print(f':> Cleaned {self.name}')
@@ -473,16 +875,27 @@ class Project:
             print(f':BUILD> {os.path.basename(self.output_file)}')
             if sources:
                 self.add_sources(sources)
+            self._schedule_units()
+            if self._tests_outdated:
+                self._unstamp_tests()
+            pruned = self._prune_outputs()
             
-            if not self._force_rebuild and self._rebuilt_objects == 0:
+            if (not self._force_rebuild and self._rebuilt_objects == 0 and not pruned and not self._relink 
+                and self._stat(self.output_file)):
                 print(f':> Not linking {os.path.basename(self.output_file)} (no changes).')
             else:
-                # compile deferred MImpls and TUnits
                 # naive try on resolving circular dependencies 
                 # by compiling all interfaces and header units first
-                while not self.deferred_commands.empty():
-                    cmd = self.deferred_commands.get()
-                    _Shell_Exec(*cmd)
+                self._compile_interfaces()
+
+                # compile deferred MImpls and TUnits:
+                # either let CL.EXE fork a compiler per core for large batches (/MP)
+                # or run the few batches side by side, but never both at once
+                multiprocess = len(self.translation_units) >= self._cores
+                self._schedule_batches(multiprocess)
+                _Shell_Exec_All(self.deferred_commands, parallel=not multiprocess, 
+                                on_success=self._on_batch_compiled)
+                self.deferred_commands.clear()
 
                 print(f':> Rebuilt {self._rebuilt_objects}/{self._total_objects} source files.')
 
@@ -495,9 +908,11 @@ class Project:
                         self._build_dll()
                     case _:
                         raise ValueError('unsupported ProjectType')
+                self._stat_cache.pop(self.output_file, None)
 
                 if self.modules.exported or self.header_units.exported:
                     self.generate_ifc_map()
+                self._save_state()
                 print(f':BUILT> {os.path.basename(self.output_file)}')
                 print('---')
 
@@ -513,52 +928,35 @@ class Project:
             _Path_Join(self.build_directory, f) for f in os.listdir(self.build_directory) 
             if os.path.basename(f).startswith('test_') and f.endswith('.exe')
         ]
-        try:
-            for test in tests:
-                testname = os.path.splitext(os.path.basename(test))[0]
-
-                print(f'TEST {self.name}::{testname}')
-                
-                p = subprocess.Popen(args=tuple(), executable=test, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                outiter = iter(p.stdout.readline, b'')
-                erriter = iter(p.stderr.readline, b'')
-                
-                while True:
-                    outline = ''
-                    errline = ''
-
-                    outstop = False
-                    try:
-                        outline = next(outiter).decode().rstrip()
-                    except StopIteration:
-                        outstop = True
-
-                    errstop = False
-                    try:
-                        errline = next(erriter).decode().rstrip()
-                    except StopIteration:
-                        errstop = True
-                    
-                    if outstop and errstop:
-                        break
-                    if verbose and outline:
-                        print(':stdout>', outline)
-                    if errline:
-                        print(bcolors.FAIL + ':stderr> ' + errline + bcolors.ENDC)
-
-                retcode = p.wait()
-                if retcode != 0:
-                    print(':exitcode>', retcode)
-                    raise RuntimeError(f'TEST {self.name}::{testname}: FAILED')
-                else:
-                    print(':exitcode> 0')
-                    print(f'TEST {self.name}::{testname}: SUCCESS')
-                    print()
-
-        except RuntimeError as e:
-            print(str(e))
+        asyncio.run(self._run_tests(tests, verbose))
+
+    # tests are separate processes with separate working directories, so they run
+    # side by side (one per core); each report is printed as a whole once its test exits
+    async def _run_tests(self, tests: list[os.PathLike], verbose: bool):
+        limit = asyncio.Semaphore(os.cpu_count() or 1)
+
+        async def run_test(test: os.PathLike):
+            retcode, stdout, stderr = await _Test_Exec(test, limit)
+            testname = os.path.splitext(os.path.basename(test))[0]
+
+            print(f'TEST {self.name}::{testname}')
+            for outline in stdout.decode().splitlines():
+                outline = outline.rstrip()
+                if verbose and outline:
+                    print(':stdout>', outline)
+            for errline in stderr.decode().splitlines():
+                errline = errline.rstrip()
+                if errline:
+                    print(bcolors.FAIL + ':stderr> ' + errline + bcolors.ENDC)
+
+            print(':exitcode>', retcode)
+            if retcode != 0:
+                print(f'TEST {self.name}::{testname}: FAILED')
+            else:
+                print(f'TEST {self.name}::{testname}: SUCCESS')
             print()
-            return
+
+        await asyncio.gather(*( run_test(test) for test in tests ))
         
     def on_target(self, target: str, *args, **kwargs):
         match target:
@@ -567,19 +965,24 @@ class Project:
             case 'rebuild':
                 self.rebuild(*args, **kwargs)
             case 'build':
-                #self.build(*args, **kwargs)
-                # TODO: correctly rebuild dependencies /<= have to analyze them first :O?
-                self.rebuild(*args, **kwargs)
+                self.build(*args, **kwargs)
             case 'test':
                 self.test()
             case _:
                 raise RuntimeError(f'Unsupported build target {target}')
 
     def _build_lib(self):
-        cmd = [ _Msvc_Tool.LibMgr.value, f'/OUT:{self.output_file}' ]
+        cmd = [ _Msvc_Tool.LibMgr.value, _LFlag.NoLogo.value, f'/OUT:{self.output_file}' ]
         cmd += self.object_files.included
         
-        _Shell_Exec(*cmd)
+        try:
+            _Shell_Exec(*cmd)
+        except CompilationError:
+            # whatever LIB.EXE left behind must not pass for an up to date library next time
+            self._stat_cache.pop(self.output_file, None)
+            if os.path.exists(self.output_file):
+                os.remove(self.output_file)
+            raise
 
     def _build_exe(self):
         pass
@@ -587,11 +990,29 @@ class Project:
     def _build_dll(self):
         pass
 
+    # tests compile against this project's ifcs, so all of them are out of date once
+    # those changed; they are unstamped up front, before anything is compiled
+    def _unstamp_tests(self):
+        if not (self.tests_directory and os.path.exists(self.tests_directory)):
+            return
+        for test in os.listdir(self.tests_directory):
+            testname, ext = os.path.splitext(test)
+            if ext == '.uxx':
+                self._unstamp(os.path.join(self._cache_directory, f'{testname}.obj'))
+
     def _build_tests(self):
         if not (self.tests_directory and os.path.exists(self.tests_directory)):
             return
          
-        for test in os.listdir(self.tests_directory):
+        # DirEntry.stat() is served from the directory listing on Windows
+        with os.scandir(self.tests_directory) as it:
+            entries = [ (entry.name, entry.stat()) for entry in it if entry.is_file() ]
+
+        if self._tests_outdated:
+            self._unstamp_tests()
+            self._tests_outdated = False
+
+        for test, test_stat in entries:
             testname, ext = os.path.splitext(os.path.basename(test))
             if (not testname.startswith('test_')) or (ext != '.uxx'):
                 print(f":> Skipping {testname}{ext} from tests directory")
@@ -602,6 +1023,7 @@ class Project:
                 continue
 
             uxx = _Path_Join(self.tests_directory, test)
+            self._stat_cache[uxx] = test_stat
             obj = os.path.join(self._cache_directory, f'{testname}.obj')
             pdb = os.path.join(self.build_directory, f'{testname}.pdb')
             exe = os.path.join(self.build_directory, f'{testname}.exe')
@@ -610,14 +1032,17 @@ class Project:
                 
             # re-compile tests if modified
             force_link = False
-            if _Should_Rebuild(uxx, obj):
-                cmd = [ _Msvc_Tool.Compiler.value, _CFlag.Linkless.value ]
+            if self._should_rebuild(uxx, obj):
+                # relinked below; unstamped first in case compiling or linking fails
+                self._unstamp(exe)
+                self._snapshot(uxx, obj)
+                cmd = [ _Msvc_Tool.Compiler.value, _CFlag.NoLogo.value, _CFlag.Linkless.value ]
                 cmd += self.config.compiler_args
                 cmd += self.common_flags
                 # cmd += self.header_units.included
                 cmd += self.ifc_maps.compiler_args
                 
-                if os.path.exists(self.ifc_map):
+                if self._stat(self.ifc_map):
                     cmd.append(_IfcFlag.IfcMap.value)
                     cmd.append(self.ifc_map)
 
@@ -627,11 +1052,13 @@ class Project:
                 cmd.append(f'/Fd{pdb}')
                 cmd.append(f'/Fe{exe}')
                 _Shell_Exec(*cmd)
+                self._stamp(uxx, obj)
                 force_link = True
 
             # re-link tests if project output file was modified
-            if force_link or _Should_Rebuild(self.output_file, exe):
-                cmd = [ _Msvc_Tool.Linker.value ]
+            if force_link or self._should_rebuild(self.output_file, exe):
+                self._snapshot(self.output_file, exe)
+                cmd = [ _Msvc_Tool.Linker.value, _LFlag.NoLogo.value ]
                 cmd += self.config.linker_args
                 cmd.append(obj)
                 
@@ -641,6 +1068,7 @@ class Project:
                 cmd.append(f'/PDB:{pdb}')
                 cmd.append(f'/OUT:{exe}')
                 _Shell_Exec(*cmd)
+                self._stamp(self.output_file, exe)
                 print(f':BUILT> {self.name}::{testname}')
             else:
                 print(f':> Not building {self.name}::{testname} (no changes).')
@@ -653,13 +1081,18 @@ class Project:
 
     def generate_ifc_map(self):
         toml = self.ifc_map
-        if _Should_Rebuild(self.output_file, toml):
+        if self._should_rebuild(self.output_file, toml):
+            parts = [ _TOML_HEADER_UNIT_TEMPLATE % (name, ifc) for name, ifc in self.header_units.exported.items() ]
+            parts += [ _TOML_MODULE_TEMPLATE % (name, ifc) for name, ifc in self.modules.exported.items() ]
+            content = ''.join(parts)
+            try:
+                with open(toml) as ifc_map:
+                    self._tests_outdated = self._tests_outdated or ifc_map.read() != content
+            except FileNotFoundError:
+                self._tests_outdated = True
             with open(toml, 'w') as ifc_map:
-                for name, ifc in self.header_units.exported.items():
-                    ifc_map.write( _TOML_HEADER_UNIT_TEMPLATE % (name, ifc) )
-                
-                for name, ifc in self.modules.exported.items():
-                    ifc_map.write( _TOML_MODULE_TEMPLATE % (name, ifc) )
+                ifc_map.write(content)
+            self._stamp(self.output_file, toml)
             print(f':> Wrote IFC map to {toml}')
     
     def link_libraries(self, *libs: 'Project'):
@@ -669,8 +1102,58 @@ class Project:
             # assert os.path.exists(lib.ifc_map), f'could not find ifc map for library {lib.name}'
             assert os.path.exists(lib.output_file), f'could not find {lib.output_file}'
             self.object_files.included.append(lib.output_file)
+            self.depends_on.add(lib.name)
+            self._linked_libraries.append(lib)
             if os.path.exists(lib.ifc_map):
-                self.ifc_maps.external[lib.name] = lib.ifc_map
+                self.ifc_maps.on_link(lib.name, lib.ifc_map)
+                self._invalidate_compile_prefix()
+
+# hardlinks src to dst, falling back to a copy across volumes;
+# a dst that already links to src is left untouched
+# .lib/.dll are hardlinked; .exe/.pdb are copied, as a running or debugged copy locks
+# the file and the linker would otherwise write the next build through the link.
+# an output that is locked is reported and left in place instead of failing the build
+def _Publish(src: os.PathLike, dst: os.PathLike, link: bool):
+    try:
+        src_stat, dst_stat = os.stat(src), os.stat(dst)
+        if os.path.samestat(src_stat, dst_stat):
+            return
+        if not link and (src_stat.st_mtime_ns, src_stat.st_size) == (dst_stat.st_mtime_ns, dst_stat.st_size):
+            return
+        os.remove(dst)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f':> Not publishing {os.path.basename(dst)} ({e.strerror}).')
+        return
+    from shutil import copy2
+    if link:
+        try:
+            return os.link(src, dst)
+        except OSError:
+            pass
+    copy2(src, dst)
+
+# redirects print() of threads that opened a log, so that projects built side by side
+# don't interleave their output; other threads still write to the real stdout
+class _Thread_Stdout(io.TextIOBase):
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self._local = threading.local()
+
+    def write(self, s: str) -> int:
+        return getattr(self._local, 'log', self.stdout).write(s)
+
+    def flush(self):
+        getattr(self._local, 'log', self.stdout).flush()
+
+    def open_log(self):
+        self._local.log = io.StringIO()
+
+    def close_log(self) -> str:
+        log = self._local.log
+        del self._local.log
+        return log.getvalue()
 
 #
 # Resembles MSBuild's terminology:
@@ -702,22 +1185,58 @@ class Solution:
         if not self.output_directory:
             return
         
-        from shutil import copy2, rmtree
-        rmtree(self.output_directory, ignore_errors=True)
         os.makedirs(self.output_directory, exist_ok=True)
         
+        published = set()
         for directory_, _, files_ in os.walk(self.build_directory):
             for file_ in files_:
                 match os.path.splitext(file_)[1]:
-                    case '.exe' | '.lib' | '.dll' | '.pdb':
-                        copy2(os.path.join(directory_, file_), self.output_directory)
+                    case '.lib' | '.dll':
+                        _Publish(os.path.join(directory_, file_), os.path.join(self.output_directory, file_), link=True)
+                        published.add(file_)
+                    case '.exe' | '.pdb':
+                        _Publish(os.path.join(directory_, file_), os.path.join(self.output_directory, file_), link=False)
+                        published.add(file_)
                     case _:
                         pass
 
+        # drop whatever previous builds published but this one didn't
+        with os.scandir(self.output_directory) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name in published:
+                    try:
+                        os.remove(entry.path)
+                    except OSError as e:
+                        print(f':> Not removing {entry.name} ({e.strerror}).')
+
     def build(self, target: str):
         print('BUILDING TARGET', target)
-        for proj in self.projects:
-            proj.on_target(target=target)
+        projects = { proj.name: proj for proj in self.projects }
+        for level in _Dependency_Levels({ proj.name: set(proj.depends_on) for proj in self.projects }):
+            if len(level) == 1:
+                projects[level[0]].on_target(target=target)
+            else:
+                self._build_level([ projects[name] for name in level ], target)
         
         self._copy_output()
 
+    # projects of a level split the cores between them and print their logs one after another
+    def _build_level(self, level: list[Project], target: str):
+        cores = max(1, (os.cpu_count() or 1) // len(level))
+        stdout = _Thread_Stdout(sys.stdout)
+
+        def build_project(proj: Project):
+            proj._cores = cores
+            stdout.open_log()
+            try:
+                proj.on_target(target=target)
+            finally:
+                stdout.stdout.write(stdout.close_log())
+
+        sys.stdout = stdout
+        try:
+            with ThreadPoolExecutor(max_workers=len(level)) as ex:
+                list(ex.map(build_project, level))
+        finally:
+            sys.stdout = stdout.stdout
+